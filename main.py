@@ -1,9 +1,19 @@
 import os
 import re
+import hmac
+import json
+import time
+import zlib
+import hashlib
+import signal
+import secrets
 import sqlite3
+import asyncio
 import logging
-from datetime import datetime
+import threading
+from collections import deque
 
+import tornado.web
 from telegram import (
     Update,
     InlineKeyboardButton,
@@ -32,6 +42,20 @@ if not ADMIN_ID:
     raise ValueError("ADMIN_ID missing. Put your Telegram numeric ID.")
 
 PORT = int(os.environ.get("PORT", "10000"))
+# FAST_START=0 forces full schema DDL + setWebhook on every boot
+FAST_START = os.getenv("FAST_START", "1").strip() != "0"
+# sent by Telegram in X-Telegram-Bot-Api-Secret-Token; generated + kept in settings if not set
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip()
+if WEBHOOK_SECRET and not re.fullmatch(r"[A-Za-z0-9_-]{1,256}", WEBHOOK_SECRET):
+    raise ValueError("WEBHOOK_SECRET invalid. Use 1-256 chars of A-Z a-z 0-9 _ -")
+# max updates waiting to be handled before the webhook answers 429
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "256") or "256")
+# bearer token for GET /stats; the endpoint is disabled when empty
+STATS_TOKEN = os.getenv("STATS_TOKEN", "").strip()
+# claimed stock older than this is moved to stock_archive
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "30") or "30")
+# admin gets an alert when an item's unclaimed stock drops to this or below
+STOCK_LOW_THRESHOLD = int(os.getenv("STOCK_LOW_THRESHOLD", "3") or "3")
 DB_PATH = os.path.join(os.path.dirname(__file__), "bot.db")
 
 logging.basicConfig(
@@ -48,17 +72,51 @@ def db():
     conn.row_factory = sqlite3.Row
     return conn
 
-def init_db():
-    conn = db()
-    cur = conn.cursor()
-
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS settings (
-        k TEXT PRIMARY KEY,
-        v TEXT NOT NULL
-    )
-    """)
+def now_ts() -> int:
+    # all timestamps are stored as integer unix epoch seconds (UTC)
+    return int(time.time())
+
+# bump when the DDL below changes
+# 1: initial schema
+# 2: items lookup table, integer epoch timestamps, stock_archive
+# 3: stats rollups (daily_stats, item_daily, counters)
+SCHEMA_VERSION = 3
+
+def column_type(cur, table: str, column: str) -> str | None:
+    cur.execute(f"PRAGMA table_info({table})")
+    for r in cur.fetchall():
+        if r["name"] == column:
+            return str(r["type"]).upper()
+    return None
 
+def migrate_v1(cur):
+    """Rewrite v1 users/stock (TEXT item + ISO timestamps) in the v2 layout."""
+    if column_type(cur, "users", "created_at") == "TEXT":
+        cur.execute("ALTER TABLE users RENAME TO users_v1")
+        create_users(cur)
+        cur.execute("""
+        INSERT INTO users (user_id, points, referred_by, ref_rewarded, verified, banned, created_at)
+        SELECT user_id, points, referred_by, ref_rewarded, verified, banned,
+               COALESCE(CAST(strftime('%s', created_at) AS INTEGER), 0)
+        FROM users_v1
+        """)
+        cur.execute("DROP TABLE users_v1")
+
+    if column_type(cur, "stock", "item") is not None:
+        cur.execute("ALTER TABLE stock RENAME TO stock_v1")
+        create_stock(cur)
+        cur.execute("INSERT OR IGNORE INTO items (name) SELECT DISTINCT item FROM stock_v1")
+        cur.execute("""
+        INSERT INTO stock (id, item_id, price, payload, added_at, claimed_by, claimed_at)
+        SELECT s.id, i.id, s.price, s.payload,
+               COALESCE(CAST(strftime('%s', s.added_at) AS INTEGER), 0),
+               s.claimed_by,
+               CAST(strftime('%s', s.claimed_at) AS INTEGER)
+        FROM stock_v1 s JOIN items i ON i.name = s.item
+        """)
+        cur.execute("DROP TABLE stock_v1")
+
+def create_users(cur):
     cur.execute("""
     CREATE TABLE IF NOT EXISTS users (
         user_id INTEGER PRIMARY KEY,
@@ -67,44 +125,321 @@ def init_db():
         ref_rewarded INTEGER NOT NULL DEFAULT 0,
         verified INTEGER NOT NULL DEFAULT 0,
         banned INTEGER NOT NULL DEFAULT 0,
-        created_at TEXT NOT NULL
+        created_at INTEGER NOT NULL  -- epoch seconds
     )
     """)
 
+def create_stock(cur):
     cur.execute("""
     CREATE TABLE IF NOT EXISTS stock (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
-        item TEXT NOT NULL,          -- e.g. "Netflix Account"
+        item_id INTEGER NOT NULL REFERENCES items(id),
         price INTEGER NOT NULL,      -- points needed
         payload TEXT NOT NULL,       -- the actual account/code text
-        added_at TEXT NOT NULL,
+        added_at INTEGER NOT NULL,   -- epoch seconds
         claimed_by INTEGER,
-        claimed_at TEXT
+        claimed_at INTEGER           -- epoch seconds
+    )
+    """)
+
+def create_rollups(cur):
+    # day = epoch day (now_ts() // 86400, UTC)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS daily_stats (
+        day INTEGER PRIMARY KEY,
+        new_users INTEGER NOT NULL DEFAULT 0,
+        referrals INTEGER NOT NULL DEFAULT 0,      -- rewarded referrals
+        points_issued INTEGER NOT NULL DEFAULT 0,
+        points_spent INTEGER NOT NULL DEFAULT 0,
+        claims INTEGER NOT NULL DEFAULT 0
+    )
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS item_daily (
+        day INTEGER NOT NULL,
+        item_id INTEGER NOT NULL REFERENCES items(id),
+        claimed INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, item_id)
+    )
+    """)
+    # running totals: users, verified
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS counters (
+        k TEXT PRIMARY KEY,
+        v INTEGER NOT NULL
+    )
+    """)
+
+def backfill_rollups(cur):
+    """
+    Seed rollups from rows that predate them. Referrals are dated by the
+    referred user's signup and points_issued can't be recovered; archived
+    stock is not included.
+    """
+    cur.execute("DELETE FROM daily_stats")
+    cur.execute("DELETE FROM item_daily")
+    cur.execute("DELETE FROM counters")
+    cur.execute("""
+    INSERT INTO daily_stats (day, new_users, referrals)
+    SELECT created_at / 86400, COUNT(*), SUM(ref_rewarded = 1)
+    FROM users GROUP BY created_at / 86400
+    """)
+    cur.execute("""
+    INSERT INTO daily_stats (day, claims, points_spent)
+    SELECT claimed_at / 86400, COUNT(*), SUM(price)
+    FROM stock WHERE claimed_by IS NOT NULL GROUP BY claimed_at / 86400
+    ON CONFLICT(day) DO UPDATE SET claims = excluded.claims, points_spent = excluded.points_spent
+    """)
+    cur.execute("""
+    INSERT INTO item_daily (day, item_id, claimed)
+    SELECT claimed_at / 86400, item_id, COUNT(*)
+    FROM stock WHERE claimed_by IS NOT NULL GROUP BY claimed_at / 86400, item_id
+    """)
+    cur.execute("INSERT INTO counters (k, v) SELECT 'users', COUNT(*) FROM users")
+    cur.execute("INSERT INTO counters (k, v) SELECT 'verified', COUNT(*) FROM users WHERE verified=1")
+
+def init_db() -> bool:
+    """
+    Create/migrate tables + defaults. Returns False if skipped because the
+    schema is already at SCHEMA_VERSION (fast start).
+    """
+    conn = db()
+    cur = conn.cursor()
+
+    # persistent in the file; lets the job/warm threads read while handlers write
+    cur.execute("PRAGMA journal_mode = WAL")
+
+    cur.execute("PRAGMA user_version")
+    version = cur.fetchone()[0]
+    if FAST_START and version == SCHEMA_VERSION:
+        conn.close()
+        return False
+
+    # only takes effect on a fresh file; existing DBs are VACUUMed below
+    cur.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    cur.execute("BEGIN")
+
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS settings (
+        k TEXT PRIMARY KEY,
+        v TEXT NOT NULL
+    )
+    """)
+
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS items (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE    -- e.g. "Netflix Account"
+    )
+    """)
+
+    create_users(cur)
+    create_stock(cur)
+    migrate_v1(cur)
+
+    # available stock lookups (count / claim) only ever touch unclaimed rows
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS stock_available
+    ON stock (item_id, price, id) WHERE claimed_by IS NULL
+    """)
+
+    # claimed rows moved out of stock by archive_claimed_stock(),
+    # `data` is zlib-compressed JSON of the rows with ids first_id..last_id
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS stock_archive (
+        id INTEGER PRIMARY KEY,
+        archived_at INTEGER NOT NULL,
+        first_id INTEGER NOT NULL,
+        last_id INTEGER NOT NULL,
+        n INTEGER NOT NULL,
+        data BLOB NOT NULL
     )
     """)
 
+    create_rollups(cur)
+    if version < 3:
+        backfill_rollups(cur)
+
     # defaults
     cur.execute("INSERT OR IGNORE INTO settings (k,v) VALUES ('reward_per_ref', '1')")
     cur.execute("INSERT OR IGNORE INTO settings (k,v) VALUES ('support_user', '@Support')")
     cur.execute("INSERT OR IGNORE INTO settings (k,v) VALUES ('required_channels', '@animatrix2026,@animatrix27')")
 
+    cur.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
     conn.commit()
+
+    cur.execute("PRAGMA auto_vacuum")
+    if cur.fetchone()[0] != 2:
+        # switching an existing file to incremental needs a full rebuild, once
+        cur.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        cur.execute("VACUUM")
     conn.close()
+    return True
 
-def get_setting(key: str) -> str:
+# =========================
+# ROLLUPS
+# =========================
+# Written in the same transaction as the event they count, so /stats only
+# ever reads a few small rows.
+def bump_daily(cur, **cols: int):
+    names = ", ".join(cols)
+    marks = ", ".join("?" for _ in cols)
+    sets = ", ".join(f"{c} = {c} + excluded.{c}" for c in cols)
+    cur.execute(
+        f"INSERT INTO daily_stats (day, {names}) VALUES (?, {marks}) ON CONFLICT(day) DO UPDATE SET {sets}",
+        (now_ts() // 86400, *cols.values()),
+    )
+
+def bump_item(cur, item_id: int, claimed: int = 1):
+    cur.execute(
+        "INSERT INTO item_daily (day, item_id, claimed) VALUES (?,?,?) "
+        "ON CONFLICT(day, item_id) DO UPDATE SET claimed = claimed + excluded.claimed",
+        (now_ts() // 86400, item_id, claimed),
+    )
+
+def bump_counter(cur, k: str, n: int = 1):
+    cur.execute(
+        "INSERT INTO counters (k, v) VALUES (?,?) ON CONFLICT(k) DO UPDATE SET v = v + excluded.v",
+        (k, n),
+    )
+
+def stats_summary(days: int = 7) -> dict:
     conn = db()
     cur = conn.cursor()
-    cur.execute("SELECT v FROM settings WHERE k=?", (key,))
-    row = cur.fetchone()
+    cur.execute("SELECT k, v FROM counters")
+    counters = {r["k"]: int(r["v"]) for r in cur.fetchall()}
+    users = counters.get("users", 0)
+    verified = counters.get("verified", 0)
+
+    cur.execute(
+        "SELECT * FROM daily_stats WHERE day > ? ORDER BY day DESC",
+        (now_ts() // 86400 - days,),
+    )
+    daily = []
+    for r in cur.fetchall():
+        d = dict(r)
+        d["day"] = time.strftime("%Y-%m-%d", time.gmtime(d["day"] * 86400))
+        daily.append(d)
+
+    cur.execute("""
+    SELECT COALESCE(SUM(referrals), 0) AS referrals,
+           COALESCE(SUM(points_issued), 0) AS points_issued,
+           COALESCE(SUM(points_spent), 0) AS points_spent,
+           COALESCE(SUM(claims), 0) AS claims
+    FROM daily_stats
+    """)
+    totals = dict(cur.fetchone())
+
+    cur.execute("""
+    SELECT i.name, SUM(d.claimed) AS c
+    FROM item_daily d JOIN items i ON i.id = d.item_id
+    GROUP BY d.item_id ORDER BY c DESC
+    """)
+    claimed_per_item = {r["name"]: int(r["c"]) for r in cur.fetchall()}
     conn.close()
-    return row["v"] if row else ""
+
+    return {
+        "users": users,
+        "verified": verified,
+        "verified_rate": round(verified / users, 4) if users else 0.0,
+        "totals": totals,
+        "days": daily,
+        "claimed_per_item": claimed_per_item,
+    }
+
+# =========================
+# CACHES
+# =========================
+# settings: k -> v
+# items: name -> items.id (rows are never deleted, so never stale)
+# stock: (item, price) -> unclaimed count
+# Writers to settings/stock hold _cache_lock across the DB write and the
+# cache update, so warm_caches() (running in a thread) can't store a stale value.
+_settings_cache: dict[str, str] = {}
+_item_ids: dict[str, int] = {}
+_stock_cache: dict[tuple[str, int], int] = {}
+_cache_lock = threading.Lock()
+
+def item_id(cur, name: str, create: bool = False) -> int | None:
+    # caller holds _cache_lock
+    iid = _item_ids.get(name)
+    if iid is not None:
+        return iid
+    if create:
+        cur.execute("INSERT OR IGNORE INTO items (name) VALUES (?)", (name,))
+    cur.execute("SELECT id FROM items WHERE name=?", (name,))
+    row = cur.fetchone()
+    if not row:
+        return None
+    _item_ids[name] = int(row["id"])
+    return _item_ids[name]
+
+def warm_caches():
+    t = time.perf_counter()
+    with _cache_lock:
+        conn = db()
+        cur = conn.cursor()
+        cur.execute("SELECT k, v FROM settings")
+        for r in cur.fetchall():
+            _settings_cache[r["k"]] = r["v"]
+        cur.execute("SELECT id, name FROM items")
+        for r in cur.fetchall():
+            _item_ids[r["name"]] = int(r["id"])
+        cur.execute("""
+        SELECT i.name, s.price, COUNT(*) AS c
+        FROM stock s JOIN items i ON i.id = s.item_id
+        WHERE s.claimed_by IS NULL
+        GROUP BY s.item_id, s.price
+        """)
+        for r in cur.fetchall():
+            _stock_cache[(r["name"], int(r["price"]))] = int(r["c"])
+        conn.close()
+    logger.info(
+        "caches warmed in %.1fms (%d settings, %d stock keys)",
+        (time.perf_counter() - t) * 1000, len(_settings_cache), len(_stock_cache),
+    )
+
+def prune_caches() -> int:
+    """Recount stock from the DB and drop keys with nothing left. Returns keys dropped."""
+    with _cache_lock:
+        conn = db()
+        cur = conn.cursor()
+        cur.execute("""
+        SELECT i.name, s.price, COUNT(*) AS c
+        FROM stock s JOIN items i ON i.id = s.item_id
+        WHERE s.claimed_by IS NULL
+        GROUP BY s.item_id, s.price
+        """)
+        fresh = {(r["name"], int(r["price"])): int(r["c"]) for r in cur.fetchall()}
+        conn.close()
+        dropped = len(set(_stock_cache) - set(fresh))
+        _stock_cache.clear()
+        _stock_cache.update(fresh)
+        return dropped
+
+def get_setting(key: str) -> str:
+    v = _settings_cache.get(key)
+    if v is not None:
+        return v
+    with _cache_lock:
+        conn = db()
+        cur = conn.cursor()
+        cur.execute("SELECT v FROM settings WHERE k=?", (key,))
+        row = cur.fetchone()
+        conn.close()
+        if not row:
+            return ""
+        _settings_cache[key] = row["v"]
+        return row["v"]
 
 def set_setting(key: str, value: str):
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("INSERT INTO settings (k,v) VALUES (?,?) ON CONFLICT(k) DO UPDATE SET v=excluded.v", (key, value))
-    conn.commit()
-    conn.close()
+    with _cache_lock:
+        conn = db()
+        cur = conn.cursor()
+        cur.execute("INSERT INTO settings (k,v) VALUES (?,?) ON CONFLICT(k) DO UPDATE SET v=excluded.v", (key, value))
+        conn.commit()
+        conn.close()
+        _settings_cache[key] = value
 
 def ensure_user(user_id: int, referred_by: int | None = None):
     conn = db()
@@ -114,8 +449,10 @@ def ensure_user(user_id: int, referred_by: int | None = None):
     if not row:
         cur.execute(
             "INSERT INTO users (user_id, points, referred_by, created_at) VALUES (?,?,?,?)",
-            (user_id, 0, referred_by, datetime.utcnow().isoformat()),
+            (user_id, 0, referred_by, now_ts()),
         )
+        bump_daily(cur, new_users=1)
+        bump_counter(cur, "users")
     else:
         # if user exists but no referred_by stored yet, store it once
         if referred_by:
@@ -137,7 +474,9 @@ def is_banned(user_id: int) -> bool:
 def set_verified(user_id: int, verified: int):
     conn = db()
     cur = conn.cursor()
-    cur.execute("UPDATE users SET verified=? WHERE user_id=?", (verified, user_id))
+    cur.execute("UPDATE users SET verified=? WHERE user_id=? AND verified!=?", (verified, user_id, verified))
+    if cur.rowcount:
+        bump_counter(cur, "verified", 1 if verified else -1)
     conn.commit()
     conn.close()
 
@@ -153,6 +492,8 @@ def add_points(user_id: int, amount: int):
     conn = db()
     cur = conn.cursor()
     cur.execute("UPDATE users SET points = points + ? WHERE user_id=?", (amount, user_id))
+    if cur.rowcount:
+        bump_daily(cur, points_issued=amount)
     conn.commit()
     conn.close()
 
@@ -168,6 +509,7 @@ def take_points(user_id: int, amount: int) -> bool:
         conn.close()
         return False
     cur.execute("UPDATE users SET points = points - ? WHERE user_id=?", (amount, user_id))
+    bump_daily(cur, points_spent=amount)
     conn.commit()
     conn.close()
     return True
@@ -194,52 +536,141 @@ def referral_reward_if_needed(new_user_id: int) -> int | None:
     # mark rewarded + give points
     cur.execute("UPDATE users SET ref_rewarded=1 WHERE user_id=?", (new_user_id,))
     cur.execute("UPDATE users SET points = points + ? WHERE user_id=?", (reward, referrer_id))
+    bump_daily(cur, referrals=1, points_issued=reward if cur.rowcount else 0)
     conn.commit()
     conn.close()
     return referrer_id
 
 def add_stock(item: str, price: int, payload: str):
+    with _cache_lock:
+        conn = db()
+        cur = conn.cursor()
+        cur.execute(
+            "INSERT INTO stock (item_id, price, payload, added_at) VALUES (?,?,?,?)",
+            (item_id(cur, item, create=True), price, payload, now_ts()),
+        )
+        conn.commit()
+        conn.close()
+        if (item, price) in _stock_cache:
+            _stock_cache[(item, price)] += 1
+
+def stock_count(item: str, price: int) -> int:
+    c = _stock_cache.get((item, price))
+    if c is not None:
+        return c
+    with _cache_lock:
+        conn = db()
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT COUNT(*) AS c FROM stock WHERE item_id=? AND price=? AND claimed_by IS NULL",
+            (item_id(cur, item), price),
+        )
+        row = cur.fetchone()
+        conn.close()
+        c = int(row["c"]) if row else 0
+        _stock_cache[(item, price)] = c
+        return c
+
+def claim_one_stock(item: str, price: int, user_id: int) -> str | None:
+    with _cache_lock:
+        conn = db()
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT id, payload FROM stock WHERE item_id=? AND price=? AND claimed_by IS NULL ORDER BY id ASC LIMIT 1",
+            (item_id(cur, item), price),
+        )
+        row = cur.fetchone()
+        if not row:
+            conn.close()
+            _stock_cache[(item, price)] = 0
+            return None
+        stock_id = int(row["id"])
+        payload = str(row["payload"])
+
+        cur.execute(
+            "UPDATE stock SET claimed_by=?, claimed_at=? WHERE id=?",
+            (user_id, now_ts(), stock_id),
+        )
+        bump_daily(cur, claims=1)
+        bump_item(cur, item_id(cur, item))
+        conn.commit()
+        conn.close()
+        if (item, price) in _stock_cache:
+            _stock_cache[(item, price)] -= 1
+        return payload
+
+ARCHIVE_BATCH = 500
+
+def archive_claimed_stock(days: int, batch: int = ARCHIVE_BATCH) -> int:
+    """
+    Move stock rows claimed more than `days` ago into stock_archive
+    (one zlib-compressed JSON blob per batch), then hand the freed pages
+    back with an incremental vacuum. Returns number of rows archived.
+    Only claimed rows move, so the unclaimed stock cache is unaffected.
+    """
+    cutoff = now_ts() - days * 86400
     conn = db()
     cur = conn.cursor()
-    cur.execute(
-        "INSERT INTO stock (item, price, payload, added_at) VALUES (?,?,?,?)",
-        (item, price, payload, datetime.utcnow().isoformat()),
-    )
-    conn.commit()
+    moved = 0
+    while True:
+        cur.execute("""
+        SELECT s.id, i.name AS item, s.price, s.payload, s.added_at, s.claimed_by, s.claimed_at
+        FROM stock s JOIN items i ON i.id = s.item_id
+        WHERE s.claimed_by IS NOT NULL AND s.claimed_at < ?
+        ORDER BY s.id ASC LIMIT ?
+        """, (cutoff, batch))
+        rows = [dict(r) for r in cur.fetchall()]
+        if not rows:
+            break
+        data = zlib.compress(json.dumps(rows, separators=(",", ":")).encode(), 9)
+        cur.execute(
+            "INSERT INTO stock_archive (archived_at, first_id, last_id, n, data) VALUES (?,?,?,?,?)",
+            (now_ts(), rows[0]["id"], rows[-1]["id"], len(rows), data),
+        )
+        cur.executemany("DELETE FROM stock WHERE id=?", [(r["id"],) for r in rows])
+        conn.commit()
+        moved += len(rows)
+
+    if moved:
+        # each step of the pragma frees one page and cursor.execute() only
+        # steps once; executescript() runs it to completion
+        conn.executescript("PRAGMA incremental_vacuum;")
     conn.close()
+    return moved
 
-def stock_count(item: str, price: int) -> int:
+def db_maintenance():
     conn = db()
     cur = conn.cursor()
-    cur.execute(
-        "SELECT COUNT(*) AS c FROM stock WHERE item=? AND price=? AND claimed_by IS NULL",
-        (item, price),
-    )
-    row = cur.fetchone()
+    cur.execute("PRAGMA optimize")
+    cur.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
     conn.close()
-    return int(row["c"]) if row else 0
 
-def claim_one_stock(item: str, price: int, user_id: int) -> str | None:
+def stock_levels() -> list[tuple[str, int, int]]:
+    """(item, price, unclaimed) for every item/price that has stock rows."""
     conn = db()
     cur = conn.cursor()
-    cur.execute(
-        "SELECT id, payload FROM stock WHERE item=? AND price=? AND claimed_by IS NULL ORDER BY id ASC LIMIT 1",
-        (item, price),
-    )
-    row = cur.fetchone()
-    if not row:
-        conn.close()
-        return None
-    stock_id = int(row["id"])
-    payload = str(row["payload"])
+    cur.execute("""
+    SELECT i.name, s.price, SUM(s.claimed_by IS NULL) AS c
+    FROM stock s JOIN items i ON i.id = s.item_id
+    GROUP BY s.item_id, s.price
+    """)
+    rows = [(r["name"], int(r["price"]), int(r["c"])) for r in cur.fetchall()]
+    conn.close()
+    return rows
 
+def pending_referrals(after_user_id: int, limit: int) -> list[int]:
+    """Unverified referred users whose referrer hasn't been rewarded yet."""
+    conn = db()
+    cur = conn.cursor()
     cur.execute(
-        "UPDATE stock SET claimed_by=?, claimed_at=? WHERE id=?",
-        (user_id, datetime.utcnow().isoformat(), stock_id),
+        "SELECT user_id FROM users "
+        "WHERE referred_by IS NOT NULL AND ref_rewarded=0 AND verified=0 AND banned=0 AND user_id>? "
+        "ORDER BY user_id ASC LIMIT ?",
+        (after_user_id, limit),
     )
-    conn.commit()
+    users = [int(r["user_id"]) for r in cur.fetchall()]
     conn.close()
-    return payload
+    return users
 
 # =========================
 # REQUIRED JOIN (channels)
@@ -270,17 +701,30 @@ async def is_member(bot, channel: str, user_id: int) -> bool:
         logger.warning(f"get_chat_member failed for {channel}: {e}")
         return False
 
-async def check_required_join(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int) -> bool:
+async def joined_all(bot, user_id: int) -> bool:
     channels = parse_channels(get_setting("required_channels"))
     if not channels:
         return True
 
     for ch in channels:
-        ok = await is_member(context.bot, ch, user_id)
+        ok = await is_member(bot, ch, user_id)
         if not ok:
             return False
     return True
 
+async def check_required_join(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int) -> bool:
+    return await joined_all(context.bot, user_id)
+
+async def notify_referrer(bot, referrer: int):
+    reward = int(get_setting("reward_per_ref") or "1")
+    try:
+        await bot.send_message(
+            chat_id=referrer,
+            text=f"✅ New referral verified!\nYou earned +{reward} point(s).",
+        )
+    except Exception:
+        pass
+
 def join_keyboard() -> InlineKeyboardMarkup:
     channels = parse_channels(get_setting("required_channels"))
     buttons = []
@@ -365,14 +809,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # reward referrer if needed
     referrer = referral_reward_if_needed(user_id)
     if referrer:
-        reward = int(get_setting("reward_per_ref") or "1")
-        try:
-            await context.bot.send_message(
-                chat_id=referrer,
-                text=f"✅ New referral verified!\nYou earned +{reward} point(s).",
-            )
-        except Exception:
-            pass
+        await notify_referrer(context.bot, referrer)
 
     await update.message.reply_text(
         "✅ Welcome! Select from menu:",
@@ -399,14 +836,7 @@ async def on_joined_check(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # reward referrer if needed (now that verified)
     referrer = referral_reward_if_needed(user_id)
     if referrer:
-        reward = int(get_setting("reward_per_ref") or "1")
-        try:
-            await context.bot.send_message(
-                chat_id=referrer,
-                text=f"✅ New referral verified!\nYou earned +{reward} point(s).",
-            )
-        except Exception:
-            pass
+        await notify_referrer(context.bot, referrer)
 
     await q.edit_message_text(
         "✅ Verified! Select from menu:",
@@ -551,6 +981,8 @@ async def admin_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/unban 123\n"
         "/add_points 123 10\n"
         "/broadcast your message...\n"
+        "/jobs\n"
+        "/stats\n"
     )
     await update.message.reply_text(txt)
 
@@ -717,13 +1149,320 @@ async def broadcast_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     await update.message.reply_text(f"✅ Broadcast done. Sent to {sent} users.")
 
+async def stats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update.message:
+        return
+    uid = update.effective_user.id
+    if not is_admin(uid):
+        return
+
+    st = stats_summary()
+    t = st["totals"]
+    lines = [
+        "📊 STATS",
+        f"Users: {st['users']} (verified {st['verified']}, {st['verified_rate'] * 100:.1f}%)",
+        f"Referrals: {t['referrals']}",
+        f"Points issued/spent: {t['points_issued']} / {t['points_spent']}",
+        "",
+        "Last 7 days (users / refs / issued / spent / claims):",
+    ]
+    for d in st["days"]:
+        lines.append(
+            f"{d['day']}: {d['new_users']} / {d['referrals']} / "
+            f"{d['points_issued']} / {d['points_spent']} / {d['claims']}"
+        )
+    lines.append("")
+    lines.append("Claimed per item:")
+    for item, c in st["claimed_per_item"].items():
+        lines.append(f"{item}: {c}")
+    await update.message.reply_text("\n".join(lines))
+
+async def jobs_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update.message:
+        return
+    uid = update.effective_user.id
+    if not is_admin(uid):
+        return
+
+    if not job_stats:
+        await update.message.reply_text("No job has run yet.")
+        return
+    lines = ["⏱ JOBS (runs / fails / last / avg / max ms):"]
+    for name, st in sorted(job_stats.items()):
+        avg = st["total_ms"] / st["runs"] if st["runs"] else 0.0
+        lines.append(
+            f"{name}: {st['runs']} / {st['failures']} / "
+            f"{st['last_ms']:.0f} / {avg:.0f} / {st['max_ms']:.0f}"
+        )
+    await update.message.reply_text("\n".join(lines))
+
 # =========================
-# MAIN
+# WEBHOOK
 # =========================
-def main():
-    init_db()
+WEBHOOK_URL = f"{APP_URL}/{BOT_TOKEN}"
+# how many recent update_ids are remembered to drop Telegram retries
+DEDUP_WINDOW = 2048
+MAX_UPDATE_BYTES = 1024 * 1024
+
+def webhook_secret() -> str:
+    """WEBHOOK_SECRET if set, else a random one generated on first boot."""
+    if WEBHOOK_SECRET:
+        return WEBHOOK_SECRET
+    secret = get_setting("webhook_secret")
+    if not secret:
+        secret = secrets.token_urlsafe(32)
+        set_setting("webhook_secret", secret)
+    return secret
+
+async def ensure_webhook(app: Application, secret: str) -> bool:
+    """
+    setWebhook only if URL/secret differ from what we last registered.
+    Returns True if setWebhook was called.
+    """
+    fingerprint = hashlib.sha256(f"{WEBHOOK_URL}|{secret}".encode()).hexdigest()
+    if FAST_START and get_setting("webhook_fingerprint") == fingerprint:
+        return False
+    await app.bot.set_webhook(url=WEBHOOK_URL, secret_token=secret)
+    set_setting("webhook_fingerprint", fingerprint)
+    return True
+
+async def refresh_webhook(app: Application, secret: str):
+    """
+    After a skipped setWebhook, register again anyway, off the cold-start
+    path (runs after app.start()). The local fingerprint can't prove what
+    Telegram has: the webhook may have been deleted, taken over by a
+    getUpdates session, or point at an older secret after a DB restore, and
+    getWebhookInfo doesn't return the secret to compare.
+    """
+    try:
+        await app.bot.set_webhook(url=WEBHOOK_URL, secret_token=secret)
+    except Exception as e:
+        logger.warning(f"webhook refresh failed: {e}")
+
+class RecentIds:
+    """Bounded set of the last `size` update_ids."""
+
+    def __init__(self, size: int):
+        self._order: deque[int] = deque()
+        self._ids: set[int] = set()
+        self._size = size
+
+    def __contains__(self, update_id: int) -> bool:
+        return update_id in self._ids
+
+    def add(self, update_id: int):
+        if update_id in self._ids:
+            return
+        self._order.append(update_id)
+        self._ids.add(update_id)
+        if len(self._order) > self._size:
+            self._ids.discard(self._order.popleft())
+
+def webhook_app(app: Application, secret: str):
+    """
+    Ingress for Telegram updates:
+      POST /<BOT_TOKEN>  403 bad secret, 400 bad body, 200 queued/duplicate,
+                         429 queue full
+      GET  /healthz      process is up
+      GET  /readyz       200 when updates are being processed and queue has room
+      GET  /stats        stats_summary() as JSON, needs "Authorization: Bearer <STATS_TOKEN>"
+    """
+    seen = RecentIds(DEDUP_WINDOW)
+    expected_secret = secret.encode()
+
+    class UpdateHandler(tornado.web.RequestHandler):
+        async def post(self):
+            # cheap checks first: header, then queue, only then parse
+            token = self.request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+            if not hmac.compare_digest(token.encode(), expected_secret):
+                self.set_status(403)
+                return
+            if app.update_queue.full():
+                self.set_status(429)
+                self.set_header("Retry-After", "1")
+                return
+
+            try:
+                data = json.loads(self.request.body)
+                update_id = int(data["update_id"])
+            except (ValueError, TypeError, KeyError):
+                self.set_status(400)
+                return
+            if update_id in seen:
+                # Telegram retry of an update we already have: ack it
+                return
+            try:
+                update = Update.de_json(data, app.bot)
+            except Exception as e:
+                logger.warning(f"bad update {update_id}: {e}")
+                self.set_status(400)
+                return
+
+            try:
+                # queued before app.start() is fine, it is drained once started
+                app.update_queue.put_nowait(update)
+            except asyncio.QueueFull:
+                self.set_status(429)
+                self.set_header("Retry-After", "1")
+                return
+            seen.add(update_id)
+
+    class HealthHandler(tornado.web.RequestHandler):
+        def get(self):
+            self.write({"ok": True})
+
+    class ReadyHandler(tornado.web.RequestHandler):
+        def get(self):
+            ready = app.running and not app.update_queue.full()
+            if not ready:
+                self.set_status(503)
+            self.write({
+                "ready": ready,
+                "running": app.running,
+                "queued": app.update_queue.qsize(),
+                "queue_size": UPDATE_QUEUE_SIZE,
+            })
+
+    class StatsHandler(tornado.web.RequestHandler):
+        async def get(self):
+            auth = self.request.headers.get("Authorization", "")
+            if not STATS_TOKEN:
+                self.set_status(404)
+                return
+            if not hmac.compare_digest(auth.encode(), f"Bearer {STATS_TOKEN}".encode()):
+                self.set_status(403)
+                return
+            try:
+                days = min(max(int(self.get_argument("days", "7")), 1), 90)
+            except ValueError:
+                self.set_status(400)
+                return
+            self.write(await asyncio.to_thread(stats_summary, days))
+
+    # IMPORTANT: url_path uses BOT_TOKEN (hard to guess), so keep it out of the access log
+    return tornado.web.Application(
+        [
+            (f"/{BOT_TOKEN}", UpdateHandler),
+            (r"/healthz", HealthHandler),
+            (r"/readyz", ReadyHandler),
+            (r"/stats", StatsHandler),
+        ],
+        log_function=lambda handler: None,
+    )
+
+# =========================
+# JOBS
+# =========================
+# all jobs run on the Application's JobQueue; intervals in seconds
+JOB_JITTER = 30                # random +-seconds on every run, so jobs don't line up
+JOB_CONCURRENCY = 2            # jobs running at the same time (across all jobs)
+JOB_FIRST_DELAY = 60           # keeps the first runs off the cold-start path
+REVERIFY_BATCH = 25            # users re-checked per run
+REVERIFY_DELAY = 0.5           # seconds between users, keeps get_chat_member well under limits
+
+# name -> runs, failures, last_ms, max_ms, total_ms, last_at
+job_stats: dict[str, dict] = {}
+_job_slots = asyncio.Semaphore(JOB_CONCURRENCY)
+# (item, price) -> unclaimed count we last alerted the admin about
+_low_alerted: dict[tuple[str, int], int] = {}
+
+def tracked(name: str, fn):
+    """Wrap a job callback with the concurrency limit and runtime metrics."""
+    async def run(context: ContextTypes.DEFAULT_TYPE):
+        st = job_stats.setdefault(
+            name, {"runs": 0, "failures": 0, "last_ms": 0.0, "max_ms": 0.0, "total_ms": 0.0, "last_at": 0}
+        )
+        async with _job_slots:
+            t = time.perf_counter()
+            try:
+                await fn(context)
+            except Exception as e:
+                st["failures"] += 1
+                logger.warning(f"job {name} failed: {e}")
+            finally:
+                ms = (time.perf_counter() - t) * 1000
+                st["runs"] += 1
+                st["last_ms"] = ms
+                st["max_ms"] = max(st["max_ms"], ms)
+                st["total_ms"] += ms
+                st["last_at"] = now_ts()
+    return run
+
+async def job_db_maintenance(context: ContextTypes.DEFAULT_TYPE):
+    await asyncio.to_thread(db_maintenance)
+
+async def job_archive(context: ContextTypes.DEFAULT_TYPE):
+    n = await asyncio.to_thread(archive_claimed_stock, ARCHIVE_AFTER_DAYS)
+    if n:
+        logger.info("archived %d claimed stock rows", n)
+
+async def job_prune_caches(context: ContextTypes.DEFAULT_TYPE):
+    await asyncio.to_thread(prune_caches)
+
+async def job_stock_low(context: ContextTypes.DEFAULT_TYPE):
+    low = []
+    for item, price, c in await asyncio.to_thread(stock_levels):
+        key = (item, price)
+        if c > STOCK_LOW_THRESHOLD:
+            _low_alerted.pop(key, None)
+        elif _low_alerted.get(key) != c:
+            _low_alerted[key] = c
+            low.append(f"{item} [{price}]: {c}")
+    if low:
+        await context.bot.send_message(chat_id=ADMIN_ID, text="⚠️ Stock low:\n" + "\n".join(low))
+
+async def job_reverify(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Re-check channel membership for users whose referral reward is still
+    pending, a batch per run. job.data["after"] walks through them across runs.
+    """
+    state = context.job.data
+    users = await asyncio.to_thread(pending_referrals, state["after"], REVERIFY_BATCH)
+    state["after"] = users[-1] if len(users) == REVERIFY_BATCH else 0
 
-    app = Application.builder().token(BOT_TOKEN).build()
+    for user_id in users:
+        if await joined_all(context.bot, user_id):
+            set_verified(user_id, 1)
+            referrer = referral_reward_if_needed(user_id)
+            if referrer:
+                await notify_referrer(context.bot, referrer)
+        await asyncio.sleep(REVERIFY_DELAY)
+
+# name, callback, interval
+JOBS = [
+    ("db_maintenance", job_db_maintenance, 3600),
+    ("archive", job_archive, 6 * 3600),
+    ("prune_caches", job_prune_caches, 1800),
+    ("stock_low", job_stock_low, 900),
+    ("reverify", job_reverify, 600),
+]
+
+def schedule_jobs(app: Application):
+    if app.job_queue is None:
+        logger.warning('JobQueue unavailable, install "python-telegram-bot[job-queue]"; no background jobs')
+        return
+    for name, fn, interval in JOBS:
+        app.job_queue.run_repeating(
+            tracked(name, fn),
+            interval=interval,
+            first=JOB_FIRST_DELAY,
+            name=name,
+            data={"after": 0} if fn is job_reverify else None,
+            job_kwargs={"jitter": JOB_JITTER},
+        )
+
+# =========================
+# MAIN
+# =========================
+def build_app() -> Application:
+    # no Updater: updates come in through webhook_app(), bounded for backpressure
+    app = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .updater(None)
+        .update_queue(asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE))
+        .build()
+    )
 
     # user
     app.add_handler(CommandHandler("start", start))
@@ -739,14 +1478,76 @@ def main():
     app.add_handler(CommandHandler("unban", unban_cmd))
     app.add_handler(CommandHandler("add_points", add_points_cmd))
     app.add_handler(CommandHandler("broadcast", broadcast_cmd))
-
-    # IMPORTANT: url_path uses BOT_TOKEN (hard to guess)
-    app.run_webhook(
-        listen="0.0.0.0",
-        port=PORT,
-        url_path=BOT_TOKEN,
-        webhook_url=f"{APP_URL}/{BOT_TOKEN}",
+    app.add_handler(CommandHandler("jobs", jobs_cmd))
+    app.add_handler(CommandHandler("stats", stats_cmd))
+
+    schedule_jobs(app)
+    return app
+
+def log_task_failure(task: asyncio.Task):
+    # surfaces background failures when they happen, not at shutdown
+    if not task.cancelled() and task.exception():
+        logger.error(f"background task {task.get_name()} failed: {task.exception()!r}")
+
+async def serve():
+    timings: dict[str, float] = {}
+    t0 = t = time.perf_counter()
+
+    def lap(name: str):
+        nonlocal t
+        now = time.perf_counter()
+        timings[name] = (now - t) * 1000
+        t = now
+
+    migrated = init_db()
+    lap("db")
+
+    app = build_app()
+    lap("build")
+
+    # listen before talking to Telegram, so Render sees the port and
+    # early updates are already queued
+    secret = webhook_secret()
+    server = webhook_app(app, secret).listen(PORT, address="0.0.0.0", max_body_size=MAX_UPDATE_BYTES)
+    lap("listen")
+
+    await app.initialize()
+    lap("init")
+
+    webhook_set = await ensure_webhook(app, secret)
+    lap("webhook")
+
+    await app.start()
+    lap("start")
+
+    background = [asyncio.create_task(asyncio.to_thread(warm_caches), name="warm_caches")]
+    if not webhook_set:
+        background.append(asyncio.create_task(refresh_webhook(app, secret), name="refresh_webhook"))
+    for task in background:
+        task.add_done_callback(log_task_failure)
+
+    logger.info(
+        "startup %.1fms (%s) schema=%s webhook=%s",
+        (time.perf_counter() - t0) * 1000,
+        " ".join(f"{k}={v:.1f}ms" for k, v in timings.items()),
+        "migrated" if migrated else "skipped",
+        "set" if webhook_set else "skipped",
     )
 
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+    server.stop()
+    # failures were already logged by log_task_failure
+    await asyncio.gather(*background, return_exceptions=True)
+    await app.stop()
+    await app.shutdown()
+
+def main():
+    asyncio.run(serve())
+
 if __name__ == "__main__":
     main()